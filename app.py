@@ -1,23 +1,28 @@
 from __future__ import annotations
 
-import io
-
+import array
+import atexit
+import json
 import os
+import queue
+import re
 import time
 import uuid
 import threading
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from flask import jsonify, redirect, url_for
-from flask import Flask, render_template, request, send_file, flash
+from flask import Flask, render_template, request, send_file, flash, session
+from flask import Response, stream_with_context
 
 from core import (
     carregar_cclass_lista,
-    cclass_desc_map,
     parse_regras_texto,
     processar_lote_zip,
     processar_lote_zip_path,  # <<< LOTE por arquivo + progresso
 
     gerar_csv_de_zip,
+    gerar_csv_de_zip_path,  # <<< CSV por arquivo (streaming)
     gerar_resumo_de_zip,
     gerar_resumo_de_zip_path,  # <<< RESUMO por arquivo + progresso
 
@@ -27,8 +32,16 @@ from core import (
 app = Flask(__name__)
 app.secret_key = "troca-xml"
 
+# CABEÇALHO;TAG por linha, ignorando vazias e comentários (#) — um único
+# scan em C no lugar do loop strip/startswith/split por linha. O \r? antes
+# do $ cobre textarea de navegador, que envia as linhas com CRLF.
+_MAPPING_RE = re.compile(r"^[ \t]*([^#;\r\n][^;\r\n]*?)[ \t]*;[ \t]*([^\r\n]+?)[ \t]*\r?$", re.M)
+
 _CCLASS_LISTA = None
 _DESC_MAP = None
+_CCLASS_LOCK = threading.Lock()
+_CCLASS_XLSX = os.path.join("data", "Tabela-cClass.xlsx")
+_CCLASS_CACHE = os.path.join(tempfile.gettempdir(), "cclass_cache.json")
 
 
 # =========================
@@ -37,44 +50,317 @@ _DESC_MAP = None
 _JOBS = {}
 _JOBS_LOCK = threading.Lock()
 
+# Pool limitado de workers: evita disparar uma thread nova por upload
+# (sob carga, dezenas de parses de XML em paralelo estouram memória).
+# ThreadPool (e não ProcessPool) porque o progresso é reportado via _JOBS,
+# que precisa ser visível no mesmo processo.
+_POOL = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1))
+atexit.register(_POOL.shutdown, wait=False)
+
+
+# =========================
+# Pool de arquivos temporários para os ZIPs enviados
+# =========================
+#
+# Em vez de criar/apagar um arquivo novo por upload (par create/unlink a
+# cada job), mantemos um conjunto fixo de "slots" pré-criados no tempdir.
+# O job pega um slot, o fzip.save() trunca e grava por cima, e no final o
+# slot volta pra fila (truncado). Os arquivos de SAÍDA continuam com nome
+# por job, porque sobrevivem ao job (ficam disponíveis pro download).
+# O pid no nome isola cada worker do gunicorn: com nome fixo, dois workers
+# entregariam o "mesmo" slot e o truncamento do import de um apagaria o
+# upload em uso no outro.
+_N_ZIP_SLOTS = 16
+_ZIP_SLOTS: queue.Queue = queue.Queue()
+for _i in range(_N_ZIP_SLOTS):
+    _p = os.path.join(tempfile.gettempdir(), f"nfcom_slot_{os.getpid()}_{_i}.zip")
+    open(_p, "wb").close()  # cria/trunca sobras de execuções anteriores
+    _ZIP_SLOTS.put(_p)
+
+
+def _zip_slot_get() -> str:
+    """Pega um slot do pool; se todos estiverem ocupados, cria um avulso."""
+    try:
+        return _ZIP_SLOTS.get_nowait()
+    except queue.Empty:
+        return os.path.join(tempfile.gettempdir(), f"nfcom_extra_{uuid.uuid4().hex[:12]}.zip")
+
+
+def _zip_slot_put(path: str) -> None:
+    """Devolve o slot truncado ao pool; slots avulsos são apagados."""
+    if "nfcom_slot_" in os.path.basename(path):
+        try:
+            open(path, "wb").close()
+        except Exception:
+            pass
+        _ZIP_SLOTS.put(path)
+    else:
+        try:
+            os.remove(path)
+        except Exception:
+            pass
+
 
 def _job_set(job_id: str, **kwargs):
+    """Atualiza metadados do job (status, erro, caminhos). Usa lock — é raro."""
     with _JOBS_LOCK:
-        _JOBS.setdefault(job_id, {})
-        _JOBS[job_id].update(kwargs)
+        j = _JOBS.setdefault(job_id, {"progress": array.array("Q", [0, 0])})
+        j.update(kwargs)
 
 
-def _job_get(job_id: str):
+def _job_progress(job_id: str) -> array.array:
+    """
+    Contador de progresso do job: array('Q', [processados, total]).
+    Escrever arr[0] = p é um store único (atômico sob o GIL), então o worker
+    atualiza progresso por arquivo SEM pegar o lock — só metadados usam lock.
+    """
     with _JOBS_LOCK:
-        return dict(_JOBS.get(job_id, {}))
+        j = _JOBS.setdefault(job_id, {"progress": array.array("Q", [0, 0])})
+        return j["progress"]
 
 
-def _processar_resumo_job(job_id: str, zip_path: str, desc_map: dict):
+def _job_get(job_id: str):
+    with _JOBS_LOCK:
+        j = _JOBS.get(job_id)
+        if j is None:
+            return {}
+        out = dict(j)
+    arr = out.pop("progress", None)
+    if arr is not None:
+        out["processed"] = int(arr[0])
+        out["total"] = int(arr[1])
+    return out
+
+
+_JOB_TTL = 30 * 60  # resultado fica disponível por 30 min após terminar
+_JOB_GC_INTERVAL = 300
+
+
+def _gc_jobs():
+    """
+    Varredura periódica do _JOBS: sem isso o dict só cresce (o result do
+    resumo pode ter MBs), um vazamento lento em servidor de longa duração.
+    Remove jobs terminados há mais de _JOB_TTL e apaga o out_path que sobrou.
+    """
+    while True:
+        time.sleep(_JOB_GC_INTERVAL)
+        cutoff = time.time() - _JOB_TTL
+        with _JOBS_LOCK:
+            mortos = [
+                (k, v.get("out_path"))
+                for k, v in _JOBS.items()
+                if v.get("finished_at", float("inf")) < cutoff
+            ]
+            for k, _ in mortos:
+                _JOBS.pop(k, None)
+        for _, out_path in mortos:
+            if out_path:
+                try:
+                    os.remove(out_path)
+                except Exception:
+                    pass
+
+
+threading.Thread(target=_gc_jobs, daemon=True).start()
+
+
+_LOADING_CACHE: dict = {}
+_JOB_ID_RE = re.compile(r"^[0-9a-f]{12}$")
+
+
+def _render_loading(template: str, job_id: str):
+    """
+    As páginas de loading são estáticas fora o job_id, mas são re-renderizadas
+    a cada hit "ainda não terminou". Renderiza o Jinja UMA vez com um
+    placeholder e daí em diante serve com um str.replace.
+
+    O base.html exibe get_flashed_messages(): se a sessão deste request tem
+    flash pendente, a página NÃO é estática — renderiza sem cache (consumindo
+    o flash normalmente) e só guarda no cache um render livre de mensagens.
+    """
+    if not _JOB_ID_RE.match(job_id):
+        return jsonify({"ok": False, "status": "not_found"}), 404
+    if session.get("_flashes"):
+        return Response(render_template(template, job_id=job_id), mimetype="text/html")
+    html = _LOADING_CACHE.get(template)
+    if html is None:
+        html = render_template(template, job_id="__JOB_ID__")
+        _LOADING_CACHE[template] = html
+    return Response(html.replace("__JOB_ID__", job_id), mimetype="text/html")
+
+
+def _run_job(
+    job_id: str,
+    fn,
+    slots=(),
+    result_key: str | None = None,
+    done_meta: dict | None = None,
+    error_cleanup=(),
+    atomic_out: str | None = None,
+    **kwargs,
+):
+    """
+    Runner genérico de job em background: marca running, instala o callback
+    de progresso, chama fn(**kwargs), marca done/error e devolve os slots
+    de temporários. Os jobs de lote e resumo só diferem na função de core
+    e no que vai pros metadados ao terminar.
+    """
     try:
-        _job_set(job_id, status="running", processed=0, total=0, started_at=time.time())
+        _job_set(job_id, status="running", started_at=time.time())
+        arr = _job_progress(job_id)
 
-        def on_prog(p, t):
-            _job_set(job_id, processed=p, total=t)
+        # Coalesce: o callback dispara por arquivo, mas o browser só consome
+        # ~2 updates/s. Propaga no máximo a cada 0,5% do total ou 100 ms —
+        # num ZIP de 50k arquivos isso corta ~99% dos updates.
+        state = [0, 0.0]  # [último p reportado, timestamp do último report]
 
-        resumo_data = gerar_resumo_de_zip_path(zip_path, desc_map=desc_map, on_progress=on_prog)
-        _job_set(job_id, status="done", result=resumo_data, finished_at=time.time())
+        def on_prog(p, t):
+            now = time.monotonic()
+            if p >= t or p - state[0] >= (t // 200 or 1) or now - state[1] >= 0.1:
+                arr[0] = p
+                arr[1] = t
+                state[0] = p
+                state[1] = now
+
+        res = fn(on_progress=on_prog, **kwargs)
+
+        # rename atômico: ninguém observa um .part pela /lote/baixar
+        if atomic_out:
+            os.replace(atomic_out + ".part", atomic_out)
+
+        done = {"status": "done", "finished_at": time.time()}
+        if result_key:
+            done[result_key] = res
+        if done_meta:
+            done.update(done_meta)
+        _job_set(job_id, **done)
     except Exception as e:
         _job_set(job_id, status="error", error=str(e), finished_at=time.time())
+        # limpa saídas parciais
+        for p in error_cleanup:
+            try:
+                if p and os.path.exists(p):
+                    os.remove(p)
+            except Exception:
+                pass
     finally:
-        try:
-            os.remove(zip_path)
-        except Exception:
-            pass
+        for p in slots:
+            _zip_slot_put(p)
 
 
 def _load_cclass():
+    """
+    Carrega a tabela cClass com duas camadas de cache:
+    memória (processo atual) e JSON em disco (workers novos do gunicorn
+    não pagam o parse do XLSX, que é ~100x mais lento que ler o cache).
+    JSON em vez de pickle porque o payload é só string — e pickle lido de
+    um caminho previsível no tempdir executaria o que qualquer usuário
+    local plantasse ali.
+    """
     global _CCLASS_LISTA, _DESC_MAP
-    if _CCLASS_LISTA is None:
+    if _CCLASS_LISTA is not None:
+        return _CCLASS_LISTA, _DESC_MAP
+
+    with _CCLASS_LOCK:
+        if _CCLASS_LISTA is not None:
+            return _CCLASS_LISTA, _DESC_MAP
+
+        # tenta o cache em disco, desde que mais novo que o XLSX de origem
+        try:
+            if (
+                os.path.exists(_CCLASS_CACHE)
+                and os.path.exists(_CCLASS_XLSX)
+                and os.path.getmtime(_CCLASS_CACHE) >= os.path.getmtime(_CCLASS_XLSX)
+            ):
+                with open(_CCLASS_CACHE, "r", encoding="utf-8") as f:
+                    _CCLASS_LISTA, _DESC_MAP = json.load(f)
+                return _CCLASS_LISTA, _DESC_MAP
+        except Exception:
+            pass
+
         _CCLASS_LISTA = carregar_cclass_lista()
-        _DESC_MAP = cclass_desc_map(_CCLASS_LISTA)
+        _DESC_MAP = {row["code"]: row["desc"] for row in _CCLASS_LISTA if row.get("code")}
+
+        try:
+            # grava num .part próprio e publica com os.replace: outro worker
+            # subindo ao mesmo tempo nunca enxerga o arquivo pela metade
+            part = f"{_CCLASS_CACHE}.{os.getpid()}.part"
+            with open(part, "w", encoding="utf-8") as f:
+                json.dump([_CCLASS_LISTA, _DESC_MAP], f, ensure_ascii=False)
+            os.replace(part, _CCLASS_CACHE)
+        except Exception:
+            # sem permissão de escrita no tempdir: segue só com o cache em memória
+            pass
+
     return _CCLASS_LISTA, _DESC_MAP
 
 
+def _job_status_payload(job_id: str) -> dict | None:
+    """Estado do job no formato consumido pelo front (status/SSE)."""
+    j = _job_get(job_id)
+    if not j:
+        return None
+
+    processed = j.get("processed", 0)
+    total = j.get("total", 0)
+    status = j.get("status", "queued")
+    return {
+        "ok": True,
+        "status": status,
+        "processed": processed,
+        "total": total,
+        "pct": (processed * 100 // total) if total else 0,
+        "error": j.get("error", ""),
+        "done": status == "done",
+    }
+
+
+def _job_status_json(job_id: str):
+    """Payload de status compartilhado por /lote/status e /resumo/status.
+
+    processed/total já saem de _job_get como int nativos (vêm do array de
+    progresso), então não há coerção por poll — só a divisão inteira do pct.
+    """
+    payload = _job_status_payload(job_id)
+    if payload is None:
+        return jsonify({"ok": False, "status": "not_found"}), 404
+    return jsonify(payload)
+
+
+def _job_events(job_id: str):
+    """
+    Gerador SSE: uma conexão longa substitui as dezenas de round-trips do
+    polling de 700 ms. Empurra o estado quando muda, manda keepalive a cada
+    15 s e encerra quando o job termina (done/erro) ou some.
+    """
+    last = None
+    idle = 0.0
+    while True:
+        payload = _job_status_payload(job_id)
+        if payload is None:
+            yield 'data: {"ok": false, "status": "not_found"}\n\n'
+            return
+        if payload != last:
+            yield f"data: {json.dumps(payload)}\n\n"
+            last = payload
+            idle = 0.0
+        if payload["done"] or payload["status"] == "error":
+            return
+        time.sleep(0.25)
+        idle += 0.25
+        if idle >= 15.0:
+            yield ":keepalive\n\n"
+            idle = 0.0
+
+
+def _sse_response(job_id: str):
+    return Response(
+        stream_with_context(_job_events(job_id)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.get("/")
 def index():
     return render_template("index.html")
@@ -95,8 +381,7 @@ def lote_processar():
 
     fzip = request.files.get("zip_xmls")
     if not fzip:
-        flash("Envie um arquivo .zip")
-        return render_template("lote.html", cclass_lista=cclass_lista)
+        return jsonify({"ok": False, "error": "Envie um arquivo .zip"}), 400
 
     remover_desconto = bool(request.form.get("remover_desconto"))
     remover_outros = bool(request.form.get("remover_outros"))
@@ -106,46 +391,49 @@ def lote_processar():
     regras = parse_regras_texto(regras_txt)
 
     job_id = uuid.uuid4().hex[:12]
-    tmp_dir = tempfile.gettempdir()
-    zip_path = os.path.join(tmp_dir, f"nfcom_lote_{job_id}.zip")
-    out_path = os.path.join(tmp_dir, f"nfcom_lote_out_{job_id}.zip")
+    zip_path = _zip_slot_get()
+    out_path = os.path.join(tempfile.gettempdir(), f"nfcom_lote_out_{job_id}.zip")
     fzip.save(zip_path)
 
-    _job_set(job_id, status="queued", processed=0, total=0, kind="lote")
+    _job_set(job_id, status="queued", kind="lote")
+
+    _POOL.submit(
+        _run_job,
+        job_id,
+        processar_lote_zip_path,
+        slots=[zip_path],
+        done_meta={"out_path": out_path},
+        error_cleanup=[out_path + ".part"],
+        atomic_out=out_path,
+        zip_path=zip_path,
+        out_path=out_path + ".part",
+        regras=regras,
+        remover_desc=remover_desconto,
+        remover_outros=remover_outros,
+    )
 
-    th = threading.Thread(
-        target=_processar_lote_job,
-        args=(job_id, zip_path, out_path, regras, remover_desconto, remover_outros),
-        daemon=True,
+    # Submissão é API pura: 202 + Location; o form faz fetch e navega
+    # pra página de loading por conta própria (nada de Jinja no submit).
+    return (
+        jsonify({"ok": True, "job_id": job_id}),
+        202,
+        {"Location": url_for("lote_status", job_id=job_id)},
     )
-    th.start()
 
-    return render_template("lote_loading.html", job_id=job_id)
+
+@app.get("/lote/loading/<job_id>")
+def lote_loading(job_id: str):
+    return _render_loading("lote_loading.html", job_id)
 
 
 @app.get("/lote/status/<job_id>")
 def lote_status(job_id: str):
-    j = _job_get(job_id)
-    if not j:
-        return jsonify({"ok": False, "status": "not_found"}), 404
-
-    processed = int(j.get("processed", 0) or 0)
-    total = int(j.get("total", 0) or 0)
-    status = j.get("status", "queued")
+    return _job_status_json(job_id)
 
-    pct = 0
-    if total > 0:
-        pct = int((processed / total) * 100)
 
-    return jsonify({
-        "ok": True,
-        "status": status,
-        "processed": processed,
-        "total": total,
-        "pct": pct,
-        "error": j.get("error", ""),
-        "done": status == "done",
-    })
+@app.get("/lote/events/<job_id>")
+def lote_events(job_id: str):
+    return _sse_response(job_id)
 
 
 @app.get("/lote/baixar/<job_id>")
@@ -160,18 +448,24 @@ def lote_baixar(job_id: str):
         return redirect(url_for("lote"))
 
     if j.get("status") != "done":
-        return render_template("lote_loading.html", job_id=job_id)
+        return _render_loading("lote_loading.html", job_id)
 
     out_path = j.get("out_path")
     if not out_path:
         flash("Arquivo de saída não encontrado.")
         return redirect(url_for("lote"))
 
+    # conditional=True faz o werkzeug responder com Content-Length,
+    # Accept-Ranges e ETag, e delega pro file_wrapper/sendfile do servidor
+    # WSGI em vez de bombear o ZIP em chunks pelo interpretador.
     return send_file(
         out_path,
         as_attachment=True,
         download_name="resultado.zip",
         mimetype="application/zip",
+        conditional=True,
+        etag=True,
+        last_modified=os.path.getmtime(out_path),
     )
 
 
@@ -217,65 +511,32 @@ def csv_gerar():
         return render_template("csv.html")
 
     mapping_txt = request.form.get("mapping_txt", "")
-    mapping = []
-    for l in (mapping_txt or "").splitlines():
-        l = l.strip()
-        if not l or l.startswith("#"):
-            continue
-        if ";" in l:
-            a, b = [x.strip() for x in l.split(";", 1)]
-            if a and b:
-                mapping.append((a, b))
+    mapping = _MAPPING_RE.findall(mapping_txt or "")
 
     if not mapping:
         flash("Informe o mapeamento no formato CABEÇALHO;TAG")
         return render_template("csv.html")
 
-    out = gerar_csv_de_zip(fzip.read(), mapping)
+    # salva o zip no disco e processa em streaming (evita segurar o ZIP inteiro em RAM)
+    token = uuid.uuid4().hex[:12]
+    zip_path = _zip_slot_get()
+    out_path = os.path.join(tempfile.gettempdir(), f"nfcom_csv_out_{token}.csv")
+    fzip.save(zip_path)
 
-    return send_file(
-        io.BytesIO(out),
+    try:
+        gerar_csv_de_zip_path(zip_path, out_path, mapping)
+    finally:
+        _zip_slot_put(zip_path)
+
+    resp = send_file(
+        out_path,
         as_attachment=True,
         download_name="relatorio.csv",
         mimetype="text/csv",
+        conditional=True,
     )
-
-
-
-
-def _processar_lote_job(job_id: str, zip_path: str, out_path: str, regras: dict, remover_desc: bool, remover_outros: bool):
-    try:
-        _job_set(job_id, status="running", processed=0, total=0, started_at=time.time())
-        def on_prog(p, t):
-            _job_set(job_id, processed=p, total=t)
-
-        processar_lote_zip_path(
-            zip_path,
-            out_path,
-            regras=regras,
-            remover_desc=remover_desc,
-            remover_outros=remover_outros,
-            on_progress=on_prog,
-        )
-
-        _job_set(job_id, status="done", out_path=out_path, finished_at=time.time())
-    except Exception as e:
-        _job_set(job_id, status="error", error=str(e), finished_at=time.time())
-        # tenta limpar saída parcial
-        try:
-            import os
-            if out_path and os.path.exists(out_path):
-                os.remove(out_path)
-        except Exception:
-            pass
-    finally:
-        # limpa zip de entrada
-        try:
-            import os
-            if zip_path and os.path.exists(zip_path):
-                os.remove(zip_path)
-        except Exception:
-            pass
+    resp.call_on_close(lambda: os.path.exists(out_path) and os.remove(out_path))
+    return resp
 
 
 # =========================
@@ -292,46 +553,45 @@ def resumo_gerar():
 
     fzip = request.files.get("zip_xmls")
     if not fzip:
-        flash("Envie um arquivo .zip")
-        return render_template("resumo.html", resumo=None)
+        return jsonify({"ok": False, "error": "Envie um arquivo .zip"}), 400
 
     # salva zip no disco (evita RAM) e processa em background
     job_id = uuid.uuid4().hex[:12]
-    tmp_dir = tempfile.gettempdir()
-    zip_path = os.path.join(tmp_dir, f"nfcom_{job_id}.zip")
+    zip_path = _zip_slot_get()
     fzip.save(zip_path)
 
-    _job_set(job_id, status="queued", processed=0, total=0)
+    _job_set(job_id, status="queued")
+
+    _POOL.submit(
+        _run_job,
+        job_id,
+        gerar_resumo_de_zip_path,
+        slots=[zip_path],
+        result_key="result",
+        zip_path=zip_path,
+        desc_map=desc_map,
+    )
+
+    return (
+        jsonify({"ok": True, "job_id": job_id}),
+        202,
+        {"Location": url_for("resumo_status", job_id=job_id)},
+    )
 
-    th = threading.Thread(target=_processar_resumo_job, args=(job_id, zip_path, desc_map), daemon=True)
-    th.start()
 
-    return render_template("resumo_loading.html", job_id=job_id)
+@app.get("/resumo/loading/<job_id>")
+def resumo_loading(job_id: str):
+    return _render_loading("resumo_loading.html", job_id)
 
 
 @app.get("/resumo/status/<job_id>")
 def resumo_status(job_id: str):
-    j = _job_get(job_id)
-    if not j:
-        return jsonify({"ok": False, "status": "not_found"}), 404
+    return _job_status_json(job_id)
 
-    processed = int(j.get("processed", 0) or 0)
-    total = int(j.get("total", 0) or 0)
-    status = j.get("status", "queued")
 
-    pct = 0
-    if total > 0:
-        pct = int((processed / total) * 100)
-
-    return jsonify({
-        "ok": True,
-        "status": status,
-        "processed": processed,
-        "total": total,
-        "pct": pct,
-        "error": j.get("error", ""),
-        "done": status == "done",
-    })
+@app.get("/resumo/events/<job_id>")
+def resumo_events(job_id: str):
+    return _sse_response(job_id)
 
 
 @app.get("/resumo/resultado/<job_id>")
@@ -346,10 +606,14 @@ def resumo_resultado(job_id: str):
         return redirect(url_for("resumo"))
 
     if j.get("status") != "done":
-        return render_template("resumo_loading.html", job_id=job_id)
+        return _render_loading("resumo_loading.html", job_id)
 
     return render_template("resumo.html", resumo=j.get("result"))
 
 
+# pré-aquece o cache da tabela cClass (a primeira request não paga o parse)
+_load_cclass()
+
+
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file
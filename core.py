@@ -1,37 +1,83 @@
 from __future__ import annotations
 
 import csv
+import functools
+import hashlib
 import io
+import mmap
+import os
 import re
+import shutil
+import sys
+import threading
 import zipfile
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Dict, List, Tuple
 import xml.etree.ElementTree as ET
 
+try:
+    # lxml (libxml2) parseia 2-5x mais rápido; opcional — tudo funciona sem.
+    from lxml import etree as _lxml_etree
+except ImportError:
+    _lxml_etree = None
+
+_LXML_LOCAL = threading.local()
+
+
+def _lxml_parser():
+    """
+    Parser lxml reutilizado entre chamadas, mas POR THREAD: o objeto
+    XMLParser não é seguro pra uso concorrente, e o Flask atende requests
+    em threads. Desliga o que não usamos — coleta de ids e resolução de
+    entidades (esta também fecha a porta de XXE).
+    """
+    p = getattr(_LXML_LOCAL, "parser", None)
+    if p is None:
+        p = _lxml_etree.XMLParser(resolve_entities=False, collect_ids=False)
+        _LXML_LOCAL.parser = p
+    return p
+
 
 # =========================
 # Util
 # =========================
+# Troca , <-> . numa passada só em C; o truque dos três .replace com "X"
+# fazia três varreduras e duas strings temporárias por valor formatado.
+_BR_TABLE = str.maketrans({",": ".", ".": ","})
+_DOT_TO_COMMA = str.maketrans(".", ",")
+# formato pt-BR -> float: some o separador de milhar e vira a vírgula em
+# ponto numa passada só (os dois .replace alocavam string intermediária)
+_BR_NUM_TABLE = str.maketrans({".": "", ",": "."})
+
+
+# Valores e datas se repetem muito dentro de um lote (mesmo plano, mesma
+# dhEmi em todos os itens da nota): memoizar transforma a re-formatação em
+# lookup. Chaves são imutáveis e o domínio por lote é pequeno.
+@functools.lru_cache(maxsize=65536)
 def _br_money(v: float) -> str:
-    s = f"{v:,.2f}"
-    s = s.replace(",", "X").replace(".", ",").replace("X", ".")
-    return f"R$ {s}"
+    return "R$ " + f"{v:,.2f}".translate(_BR_TABLE)
 
 
+@functools.lru_cache(maxsize=65536)
 def _br_num(v: float, casas: int = 2) -> str:
-    s = f"{v:,.{casas}f}"
-    return s.replace(",", "X").replace(".", ",").replace("X", ".")
+    return f"{v:,.{casas}f}".translate(_BR_TABLE)
 
 
 def _to_float(s: str | None) -> float:
     if not s:
         return 0.0
-    s = str(s).strip()
+    # o caminho quente já recebe str; o cast só roda pra tipos exóticos
+    if not isinstance(s, str):
+        s = str(s)
+    s = s.strip()
     if not s:
         return 0.0
     if "," in s:
-        s = s.replace(".", "").replace(",", ".")
+        s = s.translate(_BR_NUM_TABLE)
     try:
         return float(s)
     except Exception:
@@ -40,32 +86,109 @@ def _to_float(s: str | None) -> float:
 
 def _strip_namespaces(root: ET.Element) -> ET.Element:
     for el in root.iter():
-        if "}" in el.tag:
-            el.tag = el.tag.split("}", 1)[1]
+        tag = el.tag
+        # em lxml, comentários/PIs têm tag não-string
+        if isinstance(tag, str) and "}" in tag:
+            el.tag = tag.split("}", 1)[1]
     return root
 
 
-def _zip_iter_files(zip_bytes: bytes) -> List[Tuple[str, bytes]]:
-    out: List[Tuple[str, bytes]] = []
-    with zipfile.ZipFile(io.BytesIO(zip_bytes), "r") as z:
-        for name in z.namelist():
-            if name.endswith("/"):
-                continue
-            out.append((name, z.read(name)))
-    return out
+def _parse_xml_bytes(xml_bytes: bytes) -> ET.Element:
+    """
+    fromstring + strip de namespaces para os caminhos SÓ-LEITURA
+    (find/findall/iter). Com lxml instalado o parse roda em C; a escrita
+    (_aplicar_regras_xml_bytes) continua no ElementTree da stdlib porque
+    mistura SubElement/tostring.
+    """
+    if _lxml_etree is not None:
+        root = _lxml_etree.fromstring(xml_bytes, _lxml_parser())
+    else:
+        root = ET.fromstring(xml_bytes)
+    return _strip_namespaces(root)
+
+
+class _MmapReader(io.RawIOBase):
+    """Adaptador file-like mínimo sobre um mmap (o mmap em si não expõe
+    seekable/readinto, que o zipfile exige)."""
+
+    def __init__(self, mm: mmap.mmap):
+        self._mm = mm
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        data = self._mm.read(len(b))
+        n = len(data)
+        b[:n] = data
+        return n
+
+    def seek(self, pos: int, whence: int = io.SEEK_SET) -> int:
+        self._mm.seek(pos, whence)
+        return self._mm.tell()
+
+    def tell(self) -> int:
+        return self._mm.tell()
+
+
+@contextmanager
+def _abrir_zip_mmap(zip_path: str):
+    """
+    Abre um ZIP de disco por cima de um mmap: as leituras aleatórias das
+    entradas viram acessos ao page cache do SO, sem syscall de read por
+    chunk nem buffer intermediário em heap Python.
+    """
+    with open(zip_path, "rb") as fh:
+        try:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # arquivo vazio ou fs sem suporte: segue com o handle comum
+            with zipfile.ZipFile(fh, "r") as z:
+                yield z
+            return
+        try:
+            with zipfile.ZipFile(_MmapReader(mm), "r") as z:
+                yield z
+        finally:
+            mm.close()
 
 
-def _findtext(root: ET.Element, *paths: str, default: str = "") -> str:
+def _build_tag_index(root: ET.Element | None) -> Dict[str, List[ET.Element]]:
     """
-    Tenta vários caminhos e devolve o primeiro texto encontrado.
+    Índice tag -> elementos em UM passe de root.iter(). Extração de vários
+    campos vira hash lookup O(1) por campo, em vez de um scan completo da
+    subárvore por `.//tag` pedido.
     """
-    for p in paths:
-        el = root.find(p)
-        if el is not None and (el.text or "").strip():
-            return (el.text or "").strip()
+    # defaultdict no lugar de setdefault: este alocava uma lista vazia por
+    # nó mesmo quando o tag já estava no índice
+    idx: Dict[str, List[ET.Element]] = defaultdict(list)
+    if root is None:
+        return idx
+    for el in root.iter():
+        idx[el.tag].append(el)
+    return idx
+
+
+def _primeiro(idx: Dict[str, List[ET.Element]], tag: str) -> ET.Element | None:
+    """Primeiro elemento do tag no índice (equivale a root.find('.//tag'))."""
+    els = idx.get(tag)
+    return els[0] if els else None
+
+
+def _idx_text(idx: Dict[str, List[ET.Element]], *tags: str, default: str = "") -> str:
+    """Primeiro texto não-vazio entre as tags pedidas, usando o índice."""
+    for t in tags:
+        for el in idx.get(t, ()):
+            txt = (el.text or "").strip()
+            if txt:
+                return txt
     return default
 
 
+@functools.lru_cache(maxsize=4096)
 def _fmt_data(dh: str) -> str:
     """
     Converte ISO para dd/mm/aaaa quando possível.
@@ -99,33 +222,63 @@ def carregar_cclass_lista(xlsx_path: str = "data/Tabela-cClass.xlsx") -> List[Di
     if caminho is None:
         return []
 
-    import openpyxl
-
-    wb = openpyxl.load_workbook(caminho, data_only=True)
-    ws = wb.active
+    # cache por (caminho, mtime): o parse do XLSX domina esse caminho e a
+    # planilha quase nunca muda entre requests. Trocar o arquivo invalida
+    # sozinho (mtime muda); materializa dicts novos pra ninguém mutar o cache.
+    try:
+        mtime = caminho.stat().st_mtime
+    except OSError:
+        mtime = 0.0
+    pares = _cclass_xlsx_cached(str(caminho), mtime)
+    return [{"code": code, "desc": desc} for code, desc in pares]
 
-    header = []
-    for col in range(1, ws.max_column + 1):
-        header.append(str(ws.cell(1, col).value or "").strip().lower())
 
-    def find_col(*names: str) -> int | None:
-        for n in names:
-            n = n.lower()
-            for i, h in enumerate(header, start=1):
-                if h == n:
-                    return i
-        return None
+@functools.lru_cache(maxsize=8)
+def _cclass_xlsx_cached(caminho: str, mtime: float) -> Tuple[Tuple[str, str], ...]:
+    """Lê o XLSX uma vez por (caminho, mtime); devolve tupla imutável."""
+    import openpyxl
 
-    col_code = find_col("cclass", "codigo", "código", "code", "grupo/código") or 1
-    col_desc = find_col("descricao", "descrição", "desc") or 2
+    # read_only: parser streaming do XLSX (memória ~constante) em vez de
+    # montar o DOM da planilha inteira. Em read_only o acesso aleatório via
+    # ws.cell() é caro, então tudo sai de um único iter_rows.
+    wb = openpyxl.load_workbook(caminho, read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        rows = ws.iter_rows(values_only=True)
 
-    lista: List[Dict[str, str]] = []
-    for row in range(2, ws.max_row + 1):
-        code = str(ws.cell(row, col_code).value or "").strip()
-        desc = str(ws.cell(row, col_desc).value or "").strip()
-        if code:
-            lista.append({"code": code, "desc": desc})
-    return lista
+        try:
+            header_row = next(rows)
+        except StopIteration:
+            return ()
+        # dict header -> coluna (primeira ocorrência) no lugar do scan
+        # linear do header por candidato
+        header_idx: Dict[str, int] = {}
+        for i, h in enumerate(header_row, start=1):
+            header_idx.setdefault(str(h or "").strip().lower(), i)
+
+        def find_col(*names: str) -> int | None:
+            for n in names:
+                col = header_idx.get(n.lower())
+                if col:
+                    return col
+            return None
+
+        col_code = find_col("cclass", "codigo", "código", "code", "grupo/código") or 1
+        col_desc = find_col("descricao", "descrição", "desc") or 2
+
+        # índices resolvidos fora do loop — nada de aritmética/validação por linha
+        i_code = col_code - 1
+        i_desc = col_desc - 1
+        pares: List[Tuple[str, str]] = []
+        for row in rows:
+            code = str(row[i_code] or "").strip() if len(row) > i_code else ""
+            desc = str(row[i_desc] or "").strip() if len(row) > i_desc else ""
+            if code:
+                pares.append((code, desc))
+        return tuple(pares)
+    finally:
+        # read_only mantém o zip do XLSX aberto até fechar o workbook
+        wb.close()
 
 
 # =========================
@@ -162,50 +315,56 @@ def get_cclass_desc_map(xlsx_path: str = "data/Tabela-cClass.xlsx") -> Dict[str,
 # =========================
 # Regras texto (cClass;CFOP por linha)
 # =========================
-def parse_regras_texto(txt: str | None) -> Dict[str, str]:
-    """
-    Entrada:
-      0600101;5102
-      110201;5102
-    """
-    regras: Dict[str, str] = {}
-    if not txt:
-        return regras
+@functools.lru_cache(maxsize=128)
+def _parse_regras_texto_cached(txt: str) -> Tuple[Tuple[str, str], ...]:
+    """Parse puro e determinístico -> cacheável. Devolve tupla imutável de pares."""
+    pares: List[Tuple[str, str]] = []
     for line in txt.splitlines():
         line = line.strip()
         if not line or line.startswith("#"):
             continue
         if ";" in line:
             a, b = line.split(";", 1)
-            a = a.strip()
-            b = b.strip()
-            if a and b:
-                regras[a] = b
         elif "," in line:
             a, b = line.split(",", 1)
-            a = a.strip()
-            b = b.strip()
-            if a and b:
-                regras[a] = b
-    return regras
+        else:
+            continue
+        a = a.strip()
+        b = b.strip()
+        if a and b:
+            pares.append((a, b))
+    return tuple(pares)
+
+
+def parse_regras_texto(txt: str | None) -> Dict[str, str]:
+    """
+    Entrada:
+      0600101;5102
+      110201;5102
+
+    O mesmo texto de regras costuma ser reenviado em jobs seguidos, então o
+    parse linha-a-linha fica num LRU; aqui só materializamos o dict.
+    """
+    if not txt:
+        return {}
+    return dict(_parse_regras_texto_cached(txt))
 
 
 
 # =========================
 # LOTE (ROBUSTO): aplicar regras via XML (sem regex pesada)
 # =========================
-def _remover_tags(root: ET.Element, tag: str) -> None:
-    """Remove todas as ocorrências de um tag (sem depender de namespaces)."""
-    # Mapeia child->parent
-    parents = {}
-    for parent in root.iter():
-        for child in list(parent):
-            parents[child] = parent
-    for el in list(root.iter(tag)):
-        p = parents.get(el)
-        if p is not None:
+def _remover_tags(root: ET.Element, *tags: str) -> None:
+    """Remove todas as ocorrências dos tags pedidos (sem depender de namespaces)."""
+    # Um passe só: olha os filhos de cada elemento e remove direto no pai,
+    # em vez de montar um mapa child->parent da árvore inteira por chamada
+    # (e aceita vários tags, então vDesc+vOutro custam UMA varredura).
+    alvo = frozenset(tags)
+    for parent in list(root.iter()):
+        remover = [c for c in parent if c.tag in alvo]
+        for c in remover:
             try:
-                p.remove(el)
+                parent.remove(c)
             except Exception:
                 pass
 
@@ -218,11 +377,14 @@ def _aplicar_regras_xml_bytes(xml_bytes: bytes, regras: Dict[str, str], remover_
     except Exception:
         return xml_bytes
 
-    # Remove tags solicitadas
+    # Remove tags solicitadas (um passe cobre as duas quando ambas marcadas)
+    alvo_remocao = []
     if remover_desc:
-        _remover_tags(root, "vDesc")
+        alvo_remocao.append("vDesc")
     if remover_outros:
-        _remover_tags(root, "vOutro")
+        alvo_remocao.append("vOutro")
+    if alvo_remocao:
+        _remover_tags(root, *alvo_remocao)
 
     # Aplica CFOP por item
     # Tentamos achar itens em <det> e/ou <Item> (alguns XMLs variam)
@@ -258,6 +420,43 @@ def _aplicar_regras_xml_bytes(xml_bytes: bytes, regras: Dict[str, str], remover_
         return xml_bytes
 
 
+def _regex_pretriagem(regras: Dict[str, str], remover_desc: bool, remover_outros: bool):
+    """
+    Regex barata, em bytes crus, pra saber se ALGUM ajuste se aplica ao XML.
+
+    Na prática a maioria dos arquivos de um lote sai intacta: nenhum cClass
+    com regra e nenhuma tag a remover. Pra esses não compensa pagar decode +
+    parse + reserialização — dá pra repassar os bytes originais direto.
+    Devolve None quando não há regra nem remoção (tudo é pass-through).
+    """
+    # o mesmo conjunto de regras volta em jobs seguidos (mesmo racional do
+    # _parse_regras_texto_cached), então a compilação fica num LRU
+    return _regex_pretriagem_cached(tuple(sorted(regras)), remover_desc, remover_outros)
+
+
+@functools.lru_cache(maxsize=32)
+def _regex_pretriagem_cached(chaves: Tuple[str, ...], remover_desc: bool, remover_outros: bool):
+    # alguns XMLs chegam com prefixo de namespace (<n:cClass>); o rewriter
+    # remove os namespaces antes de casar, então a pré-triagem também
+    # precisa tolerar o prefixo — senão o arquivo passaria reto sem ajuste
+    pfx = rb"<(?:[\w.-]+:)?"
+    partes = []
+    if chaves:
+        alt = b"|".join(re.escape(k.encode("utf-8")) for k in chaves)
+        partes.append(pfx + rb"cClass\s*>\s*(?:" + alt + rb")\s*</(?:[\w.-]+:)?cClass\s*>")
+    if remover_desc:
+        partes.append(pfx + rb"vDesc\s*>")
+    if remover_outros:
+        partes.append(pfx + rb"vOutro\s*>")
+    if not partes:
+        return None
+    return re.compile(b"|".join(partes))
+
+
+# Abaixo disso não compensa pagar o fork/spawn do pool de processos
+_LOTE_POOL_MIN = 64
+
+
 def processar_lote_zip_path(
     zip_path: str,
     out_path: str,
@@ -265,74 +464,276 @@ def processar_lote_zip_path(
     remover_desc: bool,
     remover_outros: bool,
     on_progress=None,
+    max_workers: int | None = None,
 ) -> None:
-    """Processa um ZIP em disco e grava o ZIP de saída em disco (bom para muitos arquivos)."""
-    with zipfile.ZipFile(zip_path, "r") as zin:
-        nomes = [n for n in zin.namelist() if n and not n.endswith("/") ]
-        total = len(nomes)
+    """
+    Processa um ZIP em disco e grava o ZIP de saída em disco (bom para muitos arquivos).
 
-        with zipfile.ZipFile(out_path, "w", compression=zipfile.ZIP_DEFLATED) as zout:
-            for idx, name in enumerate(nomes, start=1):
-                try:
-                    data = zin.read(name)
-                except Exception:
+    Cada XML é independente, então o parse+rewrite vai para um
+    ProcessPoolExecutor (o ElementTree segura o GIL); a leitura do ZIP de
+    entrada e a escrita do de saída continuam seriais aqui. Uma janela
+    limitada de futures mantém a memória em O(janela), não O(zip).
+    """
+    if _regex_pretriagem(regras, remover_desc, remover_outros) is None:
+        # nada a aplicar: nenhuma entrada mudaria, então copiar o arquivo
+        # verbatim poupa o ciclo inteiro de descomprimir e re-deflatar
+        shutil.copyfile(zip_path, out_path)
+        if on_progress:
+            on_progress(1, 1)
+        return
+    with _abrir_zip_mmap(zip_path) as zin:
+        # classifica cada entrada UMA vez aqui; os loops abaixo não refazem
+        # lower()/endswith() por arquivo
+        entradas = [(n, n.lower().endswith(".xml")) for n in zin.namelist() if n and not n.endswith("/")]
+        total = len(entradas)
+
+        # buffer de 64 KiB no arquivo de saída: o zipfile escreve em pedaços
+        # pequenos (headers + blocos do deflate) e o default de 8 KiB vira
+        # syscall atrás de syscall em ZIP grande
+        with open(out_path, "wb", buffering=64 * 1024) as fraw, \
+                zipfile.ZipFile(fraw, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1) as zout:
+            if total < _LOTE_POOL_MIN or (max_workers is not None and max_workers <= 1):
+                _lote_serial(zin, zout, entradas, regras, remover_desc, remover_outros, on_progress)
+                return
+
+            idx = 0
+
+            def _drain(par):
+                nonlocal idx
+                name, data, fut = par
+                if fut is None:
+                    # pass-through: mantém o compress_type de origem
+                    zout.writestr(_info_passagem(zin.getinfo(name)), data)
+                    idx += 1
                     if on_progress:
-                        on: int = idx
                         on_progress(idx, total)
-                    continue
-
-                if name.lower().endswith(".xml"):
-                    data2 = _aplicar_regras_xml_bytes(data, regras, remover_desc, remover_outros)
-                    zout.writestr(name, data2)
-                else:
-                    zout.writestr(name, data)
-
+                    return
+                try:
+                    data = fut.result()
+                except Exception:
+                    pass  # mantém o original
+                zout.writestr(name, data)
+                idx += 1
                 if on_progress:
                     on_progress(idx, total)
 
+            workers = max_workers or os.cpu_count() or 1
+            janela = workers * 8
+            pre = _regex_pretriagem(regras, remover_desc, remover_outros)
+            pend: deque = deque()
+            with ProcessPoolExecutor(max_workers=workers) as ex:
+                for name, is_xml in entradas:
+                    try:
+                        data = zin.read(name)
+                    except Exception:
+                        idx += 1
+                        if on_progress:
+                            on_progress(idx, total)
+                        continue
+
+                    if is_xml and pre is not None and pre.search(data):
+                        fut = ex.submit(_aplicar_regras_xml_bytes, data, regras, remover_desc, remover_outros)
+                        pend.append((name, data, fut))
+                    else:
+                        pend.append((name, data, None))
+
+                    if len(pend) >= janela:
+                        _drain(pend.popleft())
+
+                while pend:
+                    _drain(pend.popleft())
+
+
+def _info_passagem(info: zipfile.ZipInfo) -> zipfile.ZipInfo:
+    """ZipInfo pra entrada repassada sem mudança: preserva o compress_type
+    original — conteúdo que veio STORED (já comprimido na origem) não paga
+    um deflate inútil na saída."""
+    zi = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+    zi.compress_type = info.compress_type
+    zi.external_attr = info.external_attr
+    return zi
+
+
+def _lote_serial(zin, zout, entradas, regras, remover_desc, remover_outros, on_progress) -> None:
+    total = len(entradas)
+    pre = _regex_pretriagem(regras, remover_desc, remover_outros)
+    for idx, (name, is_xml) in enumerate(entradas, start=1):
+        try:
+            data = zin.read(name)
+        except Exception:
+            if on_progress:
+                on_progress(idx, total)
+            continue
+
+        if is_xml and pre is not None and pre.search(data):
+            data2 = _aplicar_regras_xml_bytes(data, regras, remover_desc, remover_outros)
+            zout.writestr(name, data2)
+        else:
+            zout.writestr(_info_passagem(zin.getinfo(name)), data)
+
+        if on_progress:
+            on_progress(idx, total)
+
 # =========================
 # Processamento Lote ZIP -> ZIP (mantido)
 # =========================
-def _aplicar_regras_xml_str(xml_str: str, regras: Dict[str, str], remover_desc: bool, remover_outros: bool) -> str:
+# Padrões compilados UMA vez no load do módulo — a função roda uma vez por
+# arquivo do lote, então compilar/interpolar regex por chamada é o clássico
+# "compile dentro do loop".
+# Fechamentos reconhecidos como fim do "bloco" de um item
+_TERMINADORES_ITEM = (b"</det>", b"</Item>", b"</item>", b"</prod>", b"</Produto>", b"</produto>")
+_RE_VDESC = re.compile(rb"<vDesc>.*?</vDesc>", re.DOTALL)
+_RE_VOUTRO = re.compile(rb"<vOutro>.*?</vOutro>", re.DOTALL)
+# alternação única: quando as duas remoções estão ligadas, um só scan linear
+_RE_VDESC_VOUTRO = re.compile(rb"<vDesc>.*?</vDesc>|<vOutro>.*?</vOutro>", re.DOTALL)
+
+
+@functools.lru_cache(maxsize=32)
+def _subs_cfop_cached(regras_key: Tuple[Tuple[str, str], ...]) -> Dict[bytes, bytes]:
+    """cClass (bytes) -> tag <CFOP> pronta (bytes), montada uma vez por mapa
+    de regras — o scanner não interpola string nenhuma por item casado."""
+    return {
+        cc.encode("utf-8", errors="ignore"): b"<CFOP>%s</CFOP>" % cf.encode("utf-8", errors="ignore")
+        for cc, cf in regras_key
+    }
+
+
+def _aplicar_regras_xml_scan(xml_bytes: bytes, regras: Dict[str, str], remover_desc: bool, remover_outros: bool) -> bytes:
     """
     Aplica CFOP conforme cClass (quando encontra <cClass>XXXX</cClass> no item),
-    e remove algumas tags se marcado.
+    e remove algumas tags se marcado. Opera direto em bytes: as tags são ASCII
+    puro, então não há por que decodificar/recodificar o arquivo inteiro.
     """
-    # CFOP por cClass: tenta inserir/atualizar tag CFOP no mesmo "bloco" do item
-    # (simples e funcional com regex para o seu caso)
-    def repl(match):
-        cclass = match.group(1)
-        cfop = regras.get(cclass)
-        bloco = match.group(0)
-        if not cfop:
-            return bloco
+    # Scanner manual com bytes.find no lugar da regex DOTALL com lookahead —
+    # um passe linear, sem backtracking (find é busca de literal em C,
+    # então entrada malformada não degenera). As remoções de vDesc/vOutro
+    # entram como eventos do MESMO passe: cada byte do XML é lido uma vez,
+    # em vez de um scan pro CFOP e outro pras remoções.
+    eventos: List[bytes] = []
+    subs_cfop: Dict[bytes, bytes] = {}
+    if regras:
+        eventos.append(b"<cClass>")
+        # tags de substituição pré-montadas (e chaves já em bytes: o
+        # conteúdo de <cClass> nem precisa ser decodificado por item)
+        subs_cfop = _subs_cfop_cached(tuple(sorted(regras.items())))
+    if remover_desc:
+        eventos.append(b"<vDesc>")
+    if remover_outros:
+        eventos.append(b"<vOutro>")
+    if not eventos:
+        return xml_bytes
 
-        if re.search(r"<CFOP>.*?</CFOP>", bloco, flags=re.DOTALL):
-            bloco = re.sub(r"<CFOP>.*?</CFOP>", f"<CFOP>{cfop}</CFOP>", bloco, flags=re.DOTALL)
-            return bloco
+    # dentro de bloco consumido de uma vez (troca de CFOP), as remoções
+    # rodam só naquele trecho curto
+    if remover_desc and remover_outros:
+        re_remocao = _RE_VDESC_VOUTRO
+    elif remover_desc:
+        re_remocao = _RE_VDESC
+    elif remover_outros:
+        re_remocao = _RE_VOUTRO
+    else:
+        re_remocao = None
+
+    # memoryview: os trechos copiados pro resultado não viram bytes
+    # intermediários — o bytearray consome o buffer direto
+    mv = memoryview(xml_bytes)
+    out = bytearray()
+    pos = 0
+    while True:
+        hits = [(k, t) for t in eventos if (k := xml_bytes.find(t, pos)) >= 0]
+        if not hits:
+            break
+        i, tok = min(hits)
+
+        if tok != b"<cClass>":
+            # remoção de <vDesc>/<vOutro>: pula da abertura ao fechamento
+            fecho = b"</vDesc>" if tok == b"<vDesc>" else b"</vOutro>"
+            j = xml_bytes.find(fecho, i)
+            out += mv[pos:i]
+            if j < 0:
+                # sem fechamento: mantém como está (a regex também não casava)
+                out += tok
+                pos = i + len(tok)
+            else:
+                pos = j + len(fecho)
+            continue
 
-        # se não tem CFOP, insere após cClass
-        bloco = bloco.replace(f"<cClass>{cclass}</cClass>", f"<cClass>{cclass}</cClass><CFOP>{cfop}</CFOP>")
-        return bloco
+        j = xml_bytes.find(b"</cClass>", i + 8)
+        if j < 0:
+            break
+        cclass = bytes(mv[i + 8:j]).strip()
+        fim_cclass = j + 9  # logo depois de </cClass>
+        cfop_tag = subs_cfop.get(cclass)
+        if not cfop_tag:
+            out += mv[pos:fim_cclass]
+            pos = fim_cclass
+            continue
 
-    xml_str = re.sub(r"<cClass>(\d+)</cClass>.*?(?=</det>|</Item>|</item>|</prod>|</Produto>|</produto>)",
-                     repl, xml_str, flags=re.DOTALL)
+        # fim do bloco do item = terminador mais próximo (como o lookahead fazia)
+        fins = [k for k in (xml_bytes.find(t, fim_cclass) for t in _TERMINADORES_ITEM) if k >= 0]
+        if not fins:
+            # bloco sem fechamento reconhecível: não mexe (a regex também não casava)
+            out += mv[pos:fim_cclass]
+            pos = fim_cclass
+            continue
+        fim = min(fins)
+
+        bloco = bytes(mv[fim_cclass:fim])
+        c0 = bloco.find(b"<CFOP>")
+        c1 = bloco.find(b"</CFOP>", c0) if c0 >= 0 else -1
+        out += mv[pos:fim_cclass]
+        if c1 >= 0:
+            # troca o CFOP existente; o restante do bloco é consumido aqui,
+            # então as remoções rodam nesses trechos antes de emitir
+            antes, depois = bloco[:c0], bloco[c1 + 7:]
+            if re_remocao is not None:
+                antes = re_remocao.sub(b"", antes)
+                depois = re_remocao.sub(b"", depois)
+            out += antes
+            out += cfop_tag
+            out += depois
+            pos = fim
+        else:
+            # se não tem CFOP, insere após cClass; o resto do bloco segue
+            # no passe principal (as remoções ainda o alcançam)
+            out += cfop_tag
+            pos = fim_cclass
+    out += mv[pos:]
+    return bytes(out)
 
-    # Remover tags (exemplos)
-    if remover_desc:
-        xml_str = re.sub(r"<vDesc>.*?</vDesc>", "", xml_str, flags=re.DOTALL)
-    if remover_outros:
-        xml_str = re.sub(r"<vOutro>.*?</vOutro>", "", xml_str, flags=re.DOTALL)
 
-    return xml_str
+def _aplicar_regras_xml_str(xml_str: str, regras: Dict[str, str], remover_desc: bool, remover_outros: bool) -> str:
+    """Mantido por compatibilidade: variante str do scanner acima."""
+    s2 = _aplicar_regras_xml_scan(xml_str.encode("utf-8"), regras, remover_desc, remover_outros)
+    return s2.decode("utf-8", errors="ignore")
 
 
 def processar_lote_zip(zip_bytes: bytes, regras: Dict[str, str], remover_desc: bool, remover_outros: bool) -> bytes:
     """Mantido por compatibilidade: lê ZIP em memória e devolve ZIP em memória."""
+    pre = _regex_pretriagem(regras, remover_desc, remover_outros)
+    if pre is None:
+        # nada a aplicar: nenhuma entrada mudaria, então devolver o ZIP
+        # original evita descomprimir e re-deflatar o lote inteiro à toa
+        return zip_bytes
     mem_out = io.BytesIO()
-    with zipfile.ZipFile(mem_out, "w", compression=zipfile.ZIP_DEFLATED) as zout:
-        for name, data in _zip_iter_files(zip_bytes):
-            if not name.lower().endswith(".xml"):
+    # compresslevel=1: o lote é baixado uma vez; nível 1 comprime ~3x mais
+    # rápido que o default (6) com diferença marginal de tamanho em XML
+    with zipfile.ZipFile(io.BytesIO(zip_bytes), "r") as zin, \
+            zipfile.ZipFile(mem_out, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1) as zout:
+        for info in zin.infolist():
+            name = info.filename
+            if name.endswith("/"):
+                continue
+
+            if not name.lower().endswith(".xml") or pre is None:
+                # entrada que nunca muda: repassa em streaming, 64 KiB por
+                # vez, sem materializar o arquivo inteiro em memória
+                with zin.open(info) as fin, zout.open(_info_passagem(info), "w") as fout:
+                    shutil.copyfileobj(fin, fout, 64 * 1024)
+                continue
+
+            data = zin.read(info)
+            if not pre.search(data):
                 zout.writestr(name, data)
                 continue
             try:
@@ -349,25 +750,29 @@ def processar_lote_zip(zip_bytes: bytes, regras: Dict[str, str], remover_desc: b
 # Nota Única (mantido) - parse_nfcom (para resultado.html)
 # =========================
 def parse_nfcom(xml_bytes: bytes) -> Dict:
-    root = ET.fromstring(xml_bytes)
-    root = _strip_namespaces(root)
-
-    ide = root.find(".//ide")
-    emit = root.find(".//emit")
-    dest = root.find(".//dest")
-    total = root.find(".//total")
-
-    nNF = _findtext(ide, ".//nNF", default="")
-    serie = _findtext(ide, ".//serie", default="")
-    dhEmi = _findtext(ide, ".//dhEmi", ".//dEmi", default="")
-    emit_nome = _findtext(emit, ".//xNome", default="")
-    dest_nome = _findtext(dest, ".//xNome", default="")
+    root = _parse_xml_bytes(xml_bytes)
+
+    # mesmo esquema do parse_nfcom_itens: um índice por escopo troca o scan
+    # completo `.//tag` por campo lido por lookup direto no dict, e o índice
+    # do root localiza os escopos num walk só
+    idx_root = _build_tag_index(root)
+    idx_ide = _build_tag_index(_primeiro(idx_root, "ide"))
+    idx_emit = _build_tag_index(_primeiro(idx_root, "emit"))
+    idx_dest = _build_tag_index(_primeiro(idx_root, "dest"))
+    idx_total = _build_tag_index(_primeiro(idx_root, "total"))
+
+    nNF = _idx_text(idx_ide, "nNF")
+    serie = _idx_text(idx_ide, "serie")
+    dhEmi = _idx_text(idx_ide, "dhEmi", "dEmi")
+    emit_nome = _idx_text(idx_emit, "xNome")
+    dest_nome = _idx_text(idx_dest, "xNome")
 
     itens = []
-    for det in root.findall(".//det"):
-        cClass = _findtext(det, ".//cClass", default="")
-        xProd = _findtext(det, ".//xProd", default="")
-        vProd = _to_float(_findtext(det, ".//vProd", default="0"))
+    for det in idx_root.get("det", ()):
+        idx_det = _build_tag_index(det)
+        cClass = _idx_text(idx_det, "cClass")
+        xProd = _idx_text(idx_det, "xProd")
+        vProd = _to_float(_idx_text(idx_det, "vProd", default="0"))
         itens.append({
             "cClass": cClass,
             "xProd": xProd,
@@ -375,7 +780,7 @@ def parse_nfcom(xml_bytes: bytes) -> Dict:
             "vProd_br": _br_money(vProd),
         })
 
-    vNF = _to_float(_findtext(total, ".//vNF", default="0"))
+    vNF = _to_float(_idx_text(idx_total, "vNF", default="0"))
     return {
         "nNF": nNF,
         "serie": serie,
@@ -394,28 +799,133 @@ def parse_nfcom(xml_bytes: bytes) -> Dict:
 # =========================
 def gerar_csv_de_zip(zip_bytes: bytes, mapping: List[Tuple[str, str]]) -> bytes:
     # mapping: [(header, tag), ...]
-    bio = io.StringIO()
-    w = csv.writer(bio, delimiter=";")
+    # Mesmo extrator de passe único da versão em disco: um iterparse por XML
+    # no lugar de um .find(".//tag") (scan completo da árvore) por coluna.
+    campos = frozenset(campo for _, campo in mapping)
+    # Escreve encodado direto no buffer binário via TextIOWrapper: evita
+    # materializar o CSV inteiro como str e pagar um .encode() do total no
+    # fim (pico de memória de 2x o relatório).
+    bio = io.BytesIO()
+    ftxt = io.TextIOWrapper(bio, encoding="utf-8-sig", newline="")
+    w = csv.writer(ftxt, delimiter=";")
     w.writerow([m[0] for m in mapping])
 
-    for name, data in _zip_iter_files(zip_bytes):
-        if not name.lower().endswith(".xml"):
-            continue
-        root = ET.fromstring(data)
-        root = _strip_namespaces(root)
-        row = []
-        for _, campo in mapping:
-            el = root.find(f".//{campo}")
-            row.append(el.text.strip() if el is not None and el.text else "")
-        w.writerow(row)
+    # colunas desempacotadas uma vez + buffer de linha reutilizado: sem
+    # alocar uma lista nova (nem redestrinchar o mapping) por XML
+    colunas = [campo for _, campo in mapping]
+    buf = [""] * len(colunas)
 
-    return bio.getvalue().encode("utf-8-sig")
+    with zipfile.ZipFile(io.BytesIO(zip_bytes), "r") as zin:
+        for info in zin.infolist():
+            name = info.filename
+            if name.endswith("/") or not name.lower().endswith(".xml"):
+                continue
+            # o iterparse consome o stream da entrada direto, sem passar
+            # pelos bytes completos do XML em memória
+            with zin.open(info) as fp:
+                achados = _extrair_campos_stream(fp, campos)
+            for i, campo in enumerate(colunas):
+                buf[i] = achados.get(campo, "")
+            w.writerow(buf)
+
+    ftxt.flush()
+    return bio.getvalue()
+
+
+def _extrair_campos_stream(fp, campos: frozenset) -> Dict[str, str]:
+    """
+    Extrai o primeiro texto não-vazio de cada tag pedida num único passe de
+    iterparse, limpando cada elemento já visitado — a árvore nunca fica
+    inteira em memória e o parse para assim que todos os campos aparecem.
+    """
+    falta = set(campos)
+    achados: Dict[str, str] = {}
+    for _, el in ET.iterparse(fp, events=("end",)):
+        tag = el.tag.rsplit("}", 1)[-1]
+        if tag in falta:
+            txt = (el.text or "").strip()
+            if txt:
+                achados[tag] = txt
+                falta.discard(tag)
+                if not falta:
+                    break
+        el.clear()
+    return achados
+
+
+def _extrair_campos_worker(data: bytes, campos: frozenset) -> Dict[str, str]:
+    """Worker top-level (picklável) pro pool: extrai os campos de um XML."""
+    return _extrair_campos_stream(io.BytesIO(data), campos)
+
+
+def gerar_csv_de_zip_path(zip_path: str, out_path: str, mapping: List[Tuple[str, str]], max_workers: int | None = None) -> None:
+    """
+    Versão streaming do CSV: lê o ZIP direto do disco (entrada por entrada,
+    sem carregar o ZIP inteiro em RAM) e escreve o CSV direto em out_path.
+    Cada XML é percorrido uma única vez via iterparse, em vez de montar a
+    árvore completa e fazer um .find(".//tag") por coluna.
+
+    Em lotes grandes o parse (CPU) vai pro mesmo esquema do lote: pool de
+    processos com janela limitada, e um único escritor serial mantém a
+    ordem das linhas igual à do ZIP.
+    """
+    campos = frozenset(campo for _, campo in mapping)
+    with _abrir_zip_mmap(zip_path) as z, open(out_path, "w", newline="", encoding="utf-8-sig") as f:
+        w = csv.writer(f, delimiter=";")
+        w.writerow([m[0] for m in mapping])
+
+        infos = [i for i in z.infolist() if not i.filename.endswith("/") and i.filename.lower().endswith(".xml")]
+
+        # mesmo esquema do gerar_csv_de_zip: colunas resolvidas uma vez e
+        # buffer de linha reutilizado em todas as escritas
+        colunas = [campo for _, campo in mapping]
+        buf = [""] * len(colunas)
+
+        def _escrever(achados: Dict[str, str]) -> None:
+            for i, campo in enumerate(colunas):
+                buf[i] = achados.get(campo, "")
+            w.writerow(buf)
+
+        if len(infos) < _LOTE_POOL_MIN or (max_workers is not None and max_workers <= 1):
+            for info in infos:
+                try:
+                    with z.open(info) as fp:
+                        achados = _extrair_campos_stream(fp, campos)
+                except Exception:
+                    continue
+                _escrever(achados)
+            return
+
+        def _drain(fut) -> None:
+            try:
+                achados = fut.result()
+            except Exception:
+                return  # XML quebrado: pula a linha, como no serial
+            _escrever(achados)
+
+        workers = max_workers or os.cpu_count() or 1
+        janela = workers * 8
+        pend: deque = deque()
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            for info in infos:
+                try:
+                    data = z.read(info)
+                except Exception:
+                    continue
+                pend.append(ex.submit(_extrair_campos_worker, data, campos))
+                if len(pend) >= janela:
+                    _drain(pend.popleft())
+
+            while pend:
+                _drain(pend.popleft())
 
 
 # =========================
 # RESUMO (NOVO/ATUALIZADO): Itens + notas por item
 # =========================
-@dataclass
+# slots=True: sem __dict__ por instância — num lote de 100k itens isso
+# corta o dicionário por objeto e acelera o acesso aos atributos no loop
+@dataclass(slots=True)
 class ItemResumo:
     cclass: str
     xprod: str
@@ -428,6 +938,122 @@ class ItemResumo:
     cfop: str
 
 
+class _ItensTarget:
+    """
+    Target de parser pro caminho do resumo: os callbacks do expat (em C)
+    coletam só os campos que o ItemResumo usa, sem alocar um Element por nó
+    da árvore — o grosso do XML (impostos, endereços...) nem vira objeto.
+    """
+
+    _DET_TAGS = ("det", "Det", "Item", "item")
+    _CAMPOS_IDE = ("nNF", "cNF", "dhEmi", "dEmi")
+    _CAMPOS_DEST = ("xNome", "CNPJ", "CPF")
+    _CAMPOS_DET = ("cClass", "xProd", "vProd", "CFOP", "cfop", "cCFOP")
+
+    def __init__(self) -> None:
+        self._ide: Dict[str, str] = {}
+        self._dest: Dict[str, str] = {}
+        self._det: Dict[str, str] | None = None
+        self._dets_por_tag: Dict[str, List[Dict[str, str]]] = {t: [] for t in self._DET_TAGS}
+        self._escopo: Dict[str, str] | None = None
+        self._campos: Tuple[str, ...] = ()
+        self._det_tag = ""
+        self._det_depth = 0
+        self._buf: List[str] = []
+        self._coletando = False
+
+    def start(self, tag: str, attrib) -> None:
+        t = tag.rpartition("}")[2]
+        if self._det is not None:
+            if t == self._det_tag:
+                self._det_depth += 1
+        elif t in self._DET_TAGS:
+            self._det = {}
+            self._det_tag = t
+            self._det_depth = 1
+            self._escopo, self._campos = self._det, self._CAMPOS_DET
+        elif t == "ide":
+            self._escopo, self._campos = self._ide, self._CAMPOS_IDE
+        elif t == "dest":
+            self._escopo, self._campos = self._dest, self._CAMPOS_DEST
+
+        # só acumula texto quando o tag interessa no escopo atual
+        self._coletando = self._escopo is not None and t in self._campos
+        if self._coletando:
+            self._buf = []
+
+    def data(self, d: str) -> None:
+        if self._coletando:
+            self._buf.append(d)
+
+    def end(self, tag: str) -> None:
+        t = tag.rpartition("}")[2]
+        if self._coletando and t in self._campos:
+            txt = "".join(self._buf).strip()
+            # primeiro texto não-vazio por tag, como o _idx_text
+            if txt and t not in self._escopo:
+                self._escopo[t] = txt
+            self._coletando = False
+
+        if self._det is not None:
+            if t == self._det_tag:
+                self._det_depth -= 1
+                if self._det_depth == 0:
+                    self._dets_por_tag[t].append(self._det)
+                    self._det = None
+                    self._escopo = None
+                    self._campos = ()
+        elif self._escopo is not None and t in ("ide", "dest"):
+            self._escopo = None
+            self._campos = ()
+
+    def close(self) -> List[ItemResumo]:
+        nnf = self._ide.get("nNF", "")
+        cnf = self._ide.get("cNF", "")
+        dhemi = self._ide.get("dhEmi") or self._ide.get("dEmi") or ""
+        dest_nome = self._dest.get("xNome", "")
+        dest_cnpj = self._dest.get("CNPJ") or self._dest.get("CPF") or ""
+
+        # mesma prioridade de layout do caminho com árvore: det > Det > Item > item
+        dets: List[Dict[str, str]] = []
+        for t in self._DET_TAGS:
+            if self._dets_por_tag[t]:
+                dets = self._dets_por_tag[t]
+                break
+
+        itens: List[ItemResumo] = []
+        for d in dets:
+            cclass = d.get("cClass", "")
+            xprod = d.get("xProd", "")
+            vprod = _to_float(d.get("vProd", "0"))
+            cfop = d.get("CFOP") or d.get("cfop") or d.get("cCFOP") or ""
+
+            # ignora linhas vazias
+            if not cclass and not xprod and vprod == 0:
+                continue
+
+            itens.append(ItemResumo(
+                cclass=cclass,
+                xprod=xprod,
+                vprod=vprod,
+                nnf=nnf,
+                cnf=cnf,
+                dest_nome=dest_nome,
+                dest_cnpj=dest_cnpj,
+                dhemi=dhemi,
+                cfop=cfop,
+            ))
+        return itens
+
+
+# cache por hash de conteúdo: o mesmo ZIP (ou XMLs repetidos entre lotes)
+# é reenviado com frequência no fluxo web, e o parse é determinístico.
+# OrderedDict como LRU limitado; blake2b de um XML típico custa µs contra
+# ms de parse. Guarda tuplas (imutáveis) e devolve lista nova por chamada.
+_ITENS_CACHE: "OrderedDict[bytes, Tuple[ItemResumo, ...]]" = OrderedDict()
+_ITENS_CACHE_MAX = 512
+
+
 def parse_nfcom_itens(xml_bytes: bytes) -> List[ItemResumo]:
     """
     Extrai itens (xProd, cClass, vProd) + dados da nota:
@@ -437,40 +1063,69 @@ def parse_nfcom_itens(xml_bytes: bytes) -> List[ItemResumo]:
       - 'emitente' conforme seu padrão em <dest>: xNome e CNPJ/CPF
       - CFOP do item (se existir no XML)
     """
-    root = ET.fromstring(xml_bytes)
-    root = _strip_namespaces(root)
+    key = hashlib.blake2b(xml_bytes, digest_size=16).digest()
+    cached = _ITENS_CACHE.get(key)
+    if cached is not None:
+        _ITENS_CACHE.move_to_end(key)
+        return list(cached)
+
+    parser = ET.XMLParser(target=_ItensTarget())
+    parser.feed(xml_bytes)
+    itens = parser.close()
+
+    _ITENS_CACHE[key] = tuple(itens)
+    if len(_ITENS_CACHE) > _ITENS_CACHE_MAX:
+        _ITENS_CACHE.popitem(last=False)
+    return itens
+
+
+def parse_nfcom_itens_stream(fp) -> List[ItemResumo]:
+    """
+    Variante streaming: alimenta o parser em pedaços de 64 KiB direto do
+    file-like (ex.: ZipFile.open), sem materializar o XML inteiro em bytes.
+    """
+    parser = ET.XMLParser(target=_ItensTarget())
+    while True:
+        pedaco = fp.read(64 * 1024)
+        if not pedaco:
+            break
+        parser.feed(pedaco)
+    return parser.close()
+
+
+def parse_nfcom_itens_root(root: ET.Element) -> List[ItemResumo]:
+    """
+    Versão que recebe a árvore já parseada: quem precisa dos itens E de
+    outros extratores sobre o MESMO XML parseia uma vez e repassa o root,
+    em vez de pagar fromstring + strip de namespaces de novo.
+    """
+    # um walk só do documento localiza todos os escopos; cada `.//` aqui
+    # seria outro walk completo
+    idx_root = _build_tag_index(root)
 
-    ide = root.find(".//ide")
-    dest = root.find(".//dest")
+    # um índice por escopo preserva a semântica do `.//` limitado ao bloco
+    idx_ide = _build_tag_index(_primeiro(idx_root, "ide"))
+    idx_dest = _build_tag_index(_primeiro(idx_root, "dest"))
 
-    nnf = _findtext(ide, ".//nNF", default="")
-    cnf = _findtext(ide, ".//cNF", default="")
-    dhemi = _findtext(ide, ".//dhEmi", ".//dEmi", default="")
+    nnf = _idx_text(idx_ide, "nNF")
+    cnf = _idx_text(idx_ide, "cNF")
+    dhemi = _idx_text(idx_ide, "dhEmi", "dEmi")
 
-    dest_nome = _findtext(dest, ".//xNome", default="")
-    dest_cnpj = _findtext(dest, ".//CNPJ", default="") or _findtext(dest, ".//CPF", default="")
+    dest_nome = _idx_text(idx_dest, "xNome")
+    dest_cnpj = _idx_text(idx_dest, "CNPJ") or _idx_text(idx_dest, "CPF")
 
     # Itens podem variar por layout: det / Det / Item / item
-    dets = root.findall(".//det")
-    if not dets:
-        dets = root.findall(".//Det")
-    if not dets:
-        dets = root.findall(".//Item")
-    if not dets:
-        dets = root.findall(".//item")
+    dets = idx_root.get("det") or idx_root.get("Det") or idx_root.get("Item") or idx_root.get("item") or []
 
     itens: List[ItemResumo] = []
     for det in dets:
-        cclass = _findtext(det, ".//cClass", default="").strip()
-        xprod = _findtext(det, ".//xProd", default="").strip()
-        vprod = _to_float(_findtext(det, ".//vProd", default="0"))
+        idx_det = _build_tag_index(det)
+        cclass = _idx_text(idx_det, "cClass")
+        xprod = _idx_text(idx_det, "xProd")
+        vprod = _to_float(_idx_text(idx_det, "vProd", default="0"))
 
-        # CFOP pode estar em vários lugares; tenta alguns caminhos comuns
-        cfop = (
-            _findtext(det, ".//CFOP", default="").strip()
-            or _findtext(det, ".//cfop", default="").strip()
-            or _findtext(det, ".//cCFOP", default="").strip()
-        )
+        # CFOP pode estar em vários lugares; tenta alguns nomes comuns
+        cfop = _idx_text(idx_det, "CFOP", "cfop", "cCFOP")
 
         # ignora linhas vazias
         if not cclass and not xprod and vprod == 0:
@@ -502,53 +1157,76 @@ def gerar_resumo_de_zip(zip_bytes: bytes, desc_map: Dict[str, str] | None = None
     total_arquivos = 0
     total_geral = 0.0
 
-    # por cClass
-    por_cclass: Dict[str, Dict[str, float]] = {}
+    # acumuladores "colunares": [qtd_itens, v_total] por chave.
+    # Lista de 2 posições no lugar de dict aninhado: menos hashing/alocação
+    # por item no loop quente (o groupby fica por conta do defaultdict).
+    por_cclass: Dict[str, List[float]] = defaultdict(lambda: [0, 0.0])
 
     # por item (xProd + cClass)
-    por_item: Dict[Tuple[str, str], Dict[str, float]] = {}
+    por_item: Dict[Tuple[str, str], List[float]] = defaultdict(lambda: [0, 0.0])
 
     # notas por item:
     # key_item -> key_nota -> soma vprod daquele item naquela nota
     # key_nota = (nNF, cNF, dest/xNome, dhEmi)
-    por_item_notas: Dict[Tuple[str, str], Dict[Tuple[str, str, str, str], float]] = {}
-
-    for name, data in _zip_iter_files(zip_bytes):
-        if not name.lower().endswith(".xml"):
-            continue
-
-        try:
-            itens = parse_nfcom_itens(data)
-        except Exception:
-            continue
-
-        total_arquivos += 1
+    por_item_notas: Dict[Tuple[str, str], Dict[Tuple[str, str, str, str], float]] = defaultdict(
+        lambda: defaultdict(float)
+    )
+
+    # cache de tuplas compostas do request: a mesma chave lógica reusa o
+    # mesmo objeto tupla em vez de alocar uma nova a cada item
+    key_cache: Dict[tuple, tuple] = {}
+
+    # ref global vira local do loop (LOAD_FAST): chamada 3x por item
+    intern = sys.intern
+
+    with zipfile.ZipFile(io.BytesIO(zip_bytes), "r") as zin:
+        # só as entradas .xml são descomprimidas; as demais nem saem do ZIP
+        for info in zin.infolist():
+            name = info.filename
+            if name.endswith("/") or not name.lower().endswith(".xml"):
+                continue
 
-        for it in itens:
-            v = float(it.vprod)
-            total_geral += v
+            try:
+                # streaming: o XML vai do ZIP pro parser em pedaços, sem
+                # virar um bytes inteiro no meio do caminho
+                with zin.open(info) as fp:
+                    itens = parse_nfcom_itens_stream(fp)
+            except Exception:
+                continue
 
-            # cClass
-            por_cclass.setdefault(it.cclass, {"qtd_itens": 0, "v_total": 0.0})
-            por_cclass[it.cclass]["qtd_itens"] += 1
-            por_cclass[it.cclass]["v_total"] += v
+            total_arquivos += 1
 
-            # item agregado
-            key_item = (it.xprod or "(sem descrição)", it.cclass or "")
-            por_item.setdefault(key_item, {"qtd_itens": 0, "v_total": 0.0})
-            por_item[key_item]["qtd_itens"] += 1
-            por_item[key_item]["v_total"] += v
+            for it in itens:
+                v = float(it.vprod)
+                total_geral += v
 
-            # notas por item
-            key_nota = (it.nnf or "", it.cnf or "", it.dest_nome or "", it.dhemi or "")
-            por_item_notas.setdefault(key_item, {})
-            por_item_notas[key_item][key_nota] = por_item_notas[key_item].get(key_nota, 0.0) + v
+                # sys.intern: num lote os mesmos xprod/cclass/dest_nome se
+                # repetem milhares de vezes — internados, o hash/igualdade das
+                # chaves vira comparação de ponteiro e as cópias duplicadas
+                # não ficam vivas no heap
+                cclass = intern(it.cclass)
+                xprod = intern(it.xprod or "(sem descrição)")
+
+                # cClass
+                acc = por_cclass[cclass]
+                acc[0] += 1
+                acc[1] += v
+
+                # item agregado (a tupla composta também é deduplicada)
+                key_item = (xprod, cclass)
+                key_item = key_cache.setdefault(key_item, key_item)
+                acc = por_item[key_item]
+                acc[0] += 1
+                acc[1] += v
+
+                # notas por item
+                key_nota = (it.nnf or "", it.cnf or "", intern(it.dest_nome or ""), it.dhemi or "")
+                key_nota = key_cache.setdefault(key_nota, key_nota)
+                por_item_notas[key_item][key_nota] += v
 
     # monta linhas por cClass (ordenadas por valor)
     linhas = []
-    for cclass, agg in por_cclass.items():
-        v_total = float(agg["v_total"])
-        qtd = int(agg["qtd_itens"])
+    for cclass, (qtd, v_total) in por_cclass.items():
         pct = (v_total / total_geral * 100.0) if total_geral > 0 else 0.0
         linhas.append({
             "cClass": cclass,
@@ -556,7 +1234,7 @@ def gerar_resumo_de_zip(zip_bytes: bytes, desc_map: Dict[str, str] | None = None
             "v_total": v_total,
             "v_total_br": _br_money(v_total),
             "pct": pct,
-            "pct_br": f"{pct:.2f}".replace(".", ","),
+            "pct_br": f"{pct:.2f}".translate(_DOT_TO_COMMA),
         })
     linhas.sort(key=lambda x: x["v_total"], reverse=True)
 
@@ -567,9 +1245,7 @@ def gerar_resumo_de_zip(zip_bytes: bytes, desc_map: Dict[str, str] | None = None
 
     # monta itens_linhas (top 50) com notas (accordion)
     itens_linhas = []
-    for (xprod, cclass), agg in por_item.items():
-        v_total = float(agg["v_total"])
-        qtd = int(agg["qtd_itens"])
+    for (xprod, cclass), (qtd, v_total) in por_item.items():
         pct = (v_total / total_geral * 100.0) if total_geral > 0 else 0.0
 
         notas_map = por_item_notas.get((xprod, cclass), {})
@@ -594,7 +1270,7 @@ def gerar_resumo_de_zip(zip_bytes: bytes, desc_map: Dict[str, str] | None = None
             "v_total": v_total,
             "v_total_br": _br_money(v_total),
             "pct": pct,
-            "pct_br": f"{pct:.2f}".replace(".", ","),
+            "pct_br": f"{pct:.2f}".translate(_DOT_TO_COMMA),
             "notas": notas_list,
         })
 
@@ -622,23 +1298,30 @@ def gerar_dados_nota_xml(xml_bytes: bytes) -> Dict:
     - não quebrar se alguma parte não existir
     """
 
-    root = ET.fromstring(xml_bytes)
-    root = _strip_namespaces(root)
+    root = _parse_xml_bytes(xml_bytes)
 
-    ide = root.find(".//ide")
-    emit = root.find(".//emit")
-    dest = root.find(".//dest")
-    total = root.find(".//total")
+    # Índice por escopo: cada campo vira lookup O(1) num dict, no lugar de
+    # um scan completo da subárvore por caminho tentado. Os caminhos
+    # alternativos tipo `.//vBC` vs `.//ICMS//vBC` colapsam — o índice já
+    # devolve a primeira ocorrência da tag em qualquer profundidade.
+    idx_root = _build_tag_index(root)
+    idx_ide = _build_tag_index(_primeiro(idx_root, "ide"))
+    emit = _primeiro(idx_root, "emit")
+    dest = _primeiro(idx_root, "dest")
+    idx_emit = _build_tag_index(emit)
+    idx_dest = _build_tag_index(dest)
+    idx_total = _build_tag_index(_primeiro(idx_root, "total"))
 
     def join_endereco(ender: ET.Element | None) -> Tuple[str, str]:
         if ender is None:
             return "", ""
-        lgr = _findtext(ender, ".//xLgr", default="")
-        nro = _findtext(ender, ".//nro", default="")
-        bairro = _findtext(ender, ".//xBairro", default="")
-        mun = _findtext(ender, ".//xMun", default="")
-        uf = _findtext(ender, ".//UF", default="")
-        cep = _findtext(ender, ".//CEP", default="")
+        idx = _build_tag_index(ender)
+        lgr = _idx_text(idx, "xLgr")
+        nro = _idx_text(idx, "nro")
+        bairro = _idx_text(idx, "xBairro")
+        mun = _idx_text(idx, "xMun")
+        uf = _idx_text(idx, "UF")
+        cep = _idx_text(idx, "CEP")
         linha1 = " ".join([x for x in [lgr, ("nº " + nro) if nro else ""] if x]).strip()
         linha2 = " - ".join([x for x in [bairro, mun, uf] if x]).strip()
         if cep:
@@ -646,50 +1329,51 @@ def gerar_dados_nota_xml(xml_bytes: bytes) -> Dict:
         return linha1, linha2
 
     # Cabeçalho
-    nNF = _findtext(ide, ".//nNF", default="")
-    serie = _findtext(ide, ".//serie", default="")
-    cNF = _findtext(ide, ".//cNF", default="")
-    dhEmi = _findtext(ide, ".//dhEmi", ".//dEmi", default="")
-
-    emit_nome = _findtext(emit, ".//xNome", default="")
-    emit_fantasia = _findtext(emit, ".//xFant", default="")
-    emit_cnpj = _findtext(emit, ".//CNPJ", ".//CPF", default="")
-    emit_ie = _findtext(emit, ".//IE", default="")
-    emit_ender = emit.find(".//enderEmit") if emit is not None else None
+    nNF = _idx_text(idx_ide, "nNF")
+    serie = _idx_text(idx_ide, "serie")
+    cNF = _idx_text(idx_ide, "cNF")
+    dhEmi = _idx_text(idx_ide, "dhEmi", "dEmi")
+
+    emit_nome = _idx_text(idx_emit, "xNome")
+    emit_fantasia = _idx_text(idx_emit, "xFant")
+    emit_cnpj = _idx_text(idx_emit, "CNPJ", "CPF")
+    emit_ie = _idx_text(idx_emit, "IE")
+    emit_ender = _primeiro(idx_emit, "enderEmit")
     emit_l1, emit_l2 = join_endereco(emit_ender)
 
-    dest_nome = _findtext(dest, ".//xNome", default="")
-    dest_doc = _findtext(dest, ".//CNPJ", ".//CPF", default="")
-    dest_ender = dest.find(".//enderDest") if dest is not None else None
+    dest_nome = _idx_text(idx_dest, "xNome")
+    dest_doc = _idx_text(idx_dest, "CNPJ", "CPF")
+    dest_ender = _primeiro(idx_dest, "enderDest")
     dest_l1, dest_l2 = join_endereco(dest_ender)
 
     # Totais (tenta achar em vários lugares)
-    vNF = _to_float(_findtext(total, ".//vNF", default="0"))
-    bc_total = _to_float(_findtext(total, ".//vBC", ".//ICMS//vBC", default="0"))
-    icms_total = _to_float(_findtext(total, ".//vICMS", ".//ICMS//vICMS", default="0"))
-    pis_total = _to_float(_findtext(total, ".//vPIS", ".//PIS//vPIS", default="0"))
-    cofins_total = _to_float(_findtext(total, ".//vCOFINS", ".//COFINS//vCOFINS", default="0"))
-    fust_total = _to_float(_findtext(total, ".//vFUST", default="0"))
-    funttel_total = _to_float(_findtext(total, ".//vFUNTTEL", default="0"))
+    vNF = _to_float(_idx_text(idx_total, "vNF", default="0"))
+    bc_total = _to_float(_idx_text(idx_total, "vBC", default="0"))
+    icms_total = _to_float(_idx_text(idx_total, "vICMS", default="0"))
+    pis_total = _to_float(_idx_text(idx_total, "vPIS", default="0"))
+    cofins_total = _to_float(_idx_text(idx_total, "vCOFINS", default="0"))
+    fust_total = _to_float(_idx_text(idx_total, "vFUST", default="0"))
+    funttel_total = _to_float(_idx_text(idx_total, "vFUNTTEL", default="0"))
 
     # Itens
     itens: List[Dict] = []
-    for det in root.findall(".//det"):
-        cClass = _findtext(det, ".//cClass", default="")
-        xProd = _findtext(det, ".//xProd", default="")
-        cfop = _findtext(det, ".//CFOP", ".//cfop", ".//cCFOP", default="")
-        un = _findtext(det, ".//uCom", ".//uTrib", ".//uUnid", default="")
-        qtd = _to_float(_findtext(det, ".//qCom", ".//qTrib", ".//qUnid", default="0"))
-        vUnit = _to_float(_findtext(det, ".//vUnCom", ".//vUnTrib", ".//vUnid", default="0"))
-        vTotal = _to_float(_findtext(det, ".//vProd", default="0"))
-
-        v_pis = _to_float(_findtext(det, ".//PIS//vPIS", ".//vPIS", default="0"))
-        v_cofins = _to_float(_findtext(det, ".//COFINS//vCOFINS", ".//vCOFINS", default="0"))
+    for det in idx_root.get("det", ()):
+        idx_det = _build_tag_index(det)
+        cClass = _idx_text(idx_det, "cClass")
+        xProd = _idx_text(idx_det, "xProd")
+        cfop = _idx_text(idx_det, "CFOP", "cfop", "cCFOP")
+        un = _idx_text(idx_det, "uCom", "uTrib", "uUnid")
+        qtd = _to_float(_idx_text(idx_det, "qCom", "qTrib", "qUnid", default="0"))
+        vUnit = _to_float(_idx_text(idx_det, "vUnCom", "vUnTrib", "vUnid", default="0"))
+        vTotal = _to_float(_idx_text(idx_det, "vProd", default="0"))
+
+        v_pis = _to_float(_idx_text(idx_det, "vPIS", default="0"))
+        v_cofins = _to_float(_idx_text(idx_det, "vCOFINS", default="0"))
         pis_cofins = v_pis + v_cofins
 
-        bc_icms = _to_float(_findtext(det, ".//ICMS//vBC", ".//vBC", default="0"))
-        aliq_icms = _to_float(_findtext(det, ".//ICMS//pICMS", ".//pICMS", default="0"))
-        v_icms = _to_float(_findtext(det, ".//ICMS//vICMS", ".//vICMS", default="0"))
+        bc_icms = _to_float(_idx_text(idx_det, "vBC", default="0"))
+        aliq_icms = _to_float(_idx_text(idx_det, "pICMS", default="0"))
+        v_icms = _to_float(_idx_text(idx_det, "vICMS", default="0"))
 
         itens.append({
             "cClass": cClass,
@@ -745,10 +1429,65 @@ def gerar_dados_nota_xml(xml_bytes: bytes) -> Dict:
 
 
 
+def _iter_itens_zip(z, nomes, max_workers):
+    """
+    Gera (nome, itens, erro) na ordem do ZIP. Em lotes grandes o
+    parse_nfcom_itens (CPU) roda num ProcessPoolExecutor com janela
+    limitada — mesmo esquema do lote —; leitura e consumo ficam seriais.
+    """
+    serial = len(nomes) < _LOTE_POOL_MIN or (max_workers is not None and max_workers <= 1)
+    if serial:
+        # serial: streaming direto do ZIP pro parser, sem o bytes
+        # intermediário de cada arquivo (no pool o read é inevitável,
+        # porque o payload precisa ser picklado pro worker)
+        for name in nomes:
+            try:
+                with z.open(name) as fp:
+                    yield name, parse_nfcom_itens_stream(fp), ""
+            except Exception as e:
+                # leitura e parse intercalados: um erro só, cobrindo os dois
+                yield name, None, f"Falha ao processar {name}: {e}"
+        return
+
+    workers = max_workers or os.cpu_count() or 1
+    janela = workers * 8
+    pend: deque = deque()
+
+    def _resultado(par):
+        name, fut = par
+        try:
+            return name, fut.result(), ""
+        except Exception as e:
+            return name, None, f"Falha ao parsear {name}: {e}"
+
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        for name in nomes:
+            try:
+                data = z.read(name)
+            except Exception as e:
+                # drena o pendente antes, pra manter a ordem do ZIP
+                while pend:
+                    yield _resultado(pend.popleft())
+                yield name, None, f"Falha ao ler {name}: {e}"
+                continue
+
+            # sem pré-triagem por conteúdo aqui: o item é delimitado por
+            # <det>/<Item> (cClass pode faltar num item válido), então um
+            # teste de bytes barato diverge do parser — o caminho serial e
+            # o pool têm que contar exatamente os mesmos itens
+            pend.append((name, ex.submit(parse_nfcom_itens, data)))
+            if len(pend) >= janela:
+                yield _resultado(pend.popleft())
+
+        while pend:
+            yield _resultado(pend.popleft())
+
+
 def gerar_resumo_de_zip_path(
     zip_path: str,
     desc_map: Dict[str, str] | None = None,
     on_progress=None,
+    max_workers: int | None = None,
 ) -> Dict:
     """
     Lê o .zip diretamente do disco (não carrega tudo em RAM).
@@ -766,34 +1505,34 @@ def gerar_resumo_de_zip_path(
     total_geral = 0.0
 
     # Estrutura para 3 níveis: cClass -> CFOP -> Notas
-    por_cclass: Dict[str, Dict[str, float]] = {}
-    por_cclass_cfop_notas: Dict[str, Dict[str, List[Dict]]] = {}
+    # mesmos acumuladores [qtd, v_total] + defaultdict do resumo em memória:
+    # sem setdefault (que aloca o dict mesmo no hit) nem hashing duplo por item
+    por_cclass: Dict[str, List[float]] = defaultdict(lambda: [0, 0.0])
+    por_cclass_cfop_notas: Dict[str, Dict[str, List[Dict]]] = defaultdict(lambda: defaultdict(list))
 
-    por_item: Dict[Tuple[str, str], Dict[str, float]] = {}
-    por_item_notas: Dict[Tuple[str, str], Dict[Tuple[str, str, str, str], float]] = {}
+    por_item: Dict[Tuple[str, str], List[float]] = defaultdict(lambda: [0, 0.0])
+    por_item_notas: Dict[Tuple[str, str], Dict[Tuple[str, str, str, str], float]] = defaultdict(
+        lambda: defaultdict(float)
+    )
 
-    with zipfile.ZipFile(zip_path, "r") as z:
+    # cache de tuplas compostas do request (mesma ideia do resumo em memória)
+    key_cache: Dict[tuple, tuple] = {}
+
+    # refs globais viram locais (LOAD_FAST): são chamadas uma vez por item
+    br_money = _br_money
+    fmt_data = _fmt_data
+    intern = sys.intern
+
+    with _abrir_zip_mmap(zip_path) as z:
         nomes = [n for n in z.namelist() if n.lower().endswith(".xml") and not n.endswith("/")]
         total = len(nomes)
 
-        for idx, name in enumerate(nomes, start=1):
+        for idx, (name, itens, erro) in enumerate(_iter_itens_zip(z, nomes, max_workers), start=1):
             total_xml += 1
-            try:
-                data = z.read(name)
-            except Exception as e:
-                total_falhas += 1
-                if not primeiro_erro:
-                    primeiro_erro = f"Falha ao ler {name}: {e}"
-                if on_progress:
-                    on_progress(idx, total)
-                continue
-
-            try:
-                itens = parse_nfcom_itens(data)
-            except Exception as e:
+            if erro:
                 total_falhas += 1
                 if not primeiro_erro:
-                    primeiro_erro = f"Falha ao parsear {name}: {e}"
+                    primeiro_erro = erro
                 if on_progress:
                     on_progress(idx, total)
                 continue
@@ -818,48 +1557,48 @@ def gerar_resumo_de_zip_path(
                 v = float(it.vprod)
                 total_geral += v
 
+                # sys.intern: xprod/cclass/dest_nome se repetem muito num
+                # lote — internados, hash/igualdade das chaves sai no ponteiro
+                cclass = intern(it.cclass)
+                xprod = intern(it.xprod or "(sem descrição)")
+
                 # Nível 1: cClass
-                por_cclass.setdefault(it.cclass, {"qtd_itens": 0, "v_total": 0.0})
-                por_cclass[it.cclass]["qtd_itens"] += 1
-                por_cclass[it.cclass]["v_total"] += v
+                acc = por_cclass[cclass]
+                acc[0] += 1
+                acc[1] += v
 
                 # Nível 2: CFOP dentro do cClass
                 cfop = it.cfop or "(sem CFOP)"
-                if it.cclass not in por_cclass_cfop_notas:
-                    por_cclass_cfop_notas[it.cclass] = {}
-                if cfop not in por_cclass_cfop_notas[it.cclass]:
-                    por_cclass_cfop_notas[it.cclass][cfop] = []
-                
+
                 # Nível 3: Nota dentro do CFOP
-                por_cclass_cfop_notas[it.cclass][cfop].append({
+                por_cclass_cfop_notas[cclass][cfop].append({
                     "nNF": it.nnf or "",
                     "cNF": it.cnf or "",
                     "xNome": it.dest_nome or "",
                     "dhEmi": it.dhemi or "",
-                    "dhEmi_fmt": _fmt_data(it.dhemi or ""),
+                    "dhEmi_fmt": fmt_data(it.dhemi or ""),
                     "cfop": cfop,
                     "vProd": v,
-                    "vProd_br": _br_money(v)
+                    "vProd_br": br_money(v)
                 })
 
-                # Para a tabela de itens (mantido)
-                key_item = (it.xprod or "(sem descrição)", it.cclass or "")
-                por_item.setdefault(key_item, {"qtd_itens": 0, "v_total": 0.0})
-                por_item[key_item]["qtd_itens"] += 1
-                por_item[key_item]["v_total"] += v
+                # Para a tabela de itens (mantido); tupla composta deduplicada
+                key_item = (xprod, cclass)
+                key_item = key_cache.setdefault(key_item, key_item)
+                acc = por_item[key_item]
+                acc[0] += 1
+                acc[1] += v
 
-                key_nota = (it.nnf or "", it.cnf or "", it.dest_nome or "", it.dhemi or "")
-                por_item_notas.setdefault(key_item, {})
-                por_item_notas[key_item][key_nota] = por_item_notas[key_item].get(key_nota, 0.0) + v
+                key_nota = (it.nnf or "", it.cnf or "", intern(it.dest_nome or ""), it.dhemi or "")
+                key_nota = key_cache.setdefault(key_nota, key_nota)
+                por_item_notas[key_item][key_nota] += v
 
             if on_progress:
                 on_progress(idx, total)
 
     # Montar estrutura final com 3 níveis
     linhas = []
-    for cclass, agg in por_cclass.items():
-        v_total = float(agg["v_total"])
-        qtd = int(agg["qtd_itens"])
+    for cclass, (qtd, v_total) in por_cclass.items():
         pct = (v_total / total_geral * 100.0) if total_geral > 0 else 0.0
         
         # Obter CFOPs para este cClass
@@ -886,7 +1625,7 @@ def gerar_resumo_de_zip_path(
             "v_total": v_total,
             "v_total_br": _br_money(v_total),
             "pct": pct,
-            "pct_br": f"{pct:.2f}".replace(".", ","),
+            "pct_br": f"{pct:.2f}".translate(_DOT_TO_COMMA),
             "cfops": cfops_data  # Novo: lista de CFOPs com suas notas
         })
     
@@ -898,9 +1637,7 @@ def gerar_resumo_de_zip_path(
 
     # Itens (todos) mantendo comportamento anterior
     itens_linhas = []
-    for (xprod, cclass), agg in por_item.items():
-        v_total = float(agg["v_total"])
-        qtd = int(agg["qtd_itens"])
+    for (xprod, cclass), (qtd, v_total) in por_item.items():
         pct = (v_total / total_geral * 100.0) if total_geral > 0 else 0.0
 
         notas_map = por_item_notas.get((xprod, cclass), {})
@@ -924,7 +1661,7 @@ def gerar_resumo_de_zip_path(
             "v_total": v_total,
             "v_total_br": _br_money(v_total),
             "pct": pct,
-            "pct_br": f"{pct:.2f}".replace(".", ","),
+            "pct_br": f"{pct:.2f}".translate(_DOT_TO_COMMA),
             "notas": notas_list,
         })
     itens_linhas.sort(key=lambda x: x["v_total"], reverse=True)